@@ -1,19 +1,31 @@
-import json
+import httpx
 import logging
+import orjson
 import os
 import sentry_sdk
 import time
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from github import Github
-from github.GithubException import GithubException
+from fastapi.responses import Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, generate_latest
 from sentry_sdk.integrations.logging import LoggingIntegration
 from sentry_sdk.crons import capture_checkin
 from sentry_sdk.crons.consts import MonitorStatus
 from textwrap import dedent
+from urllib.parse import quote
 from utils import (
     set_up_logging,
-    get_github_token,
+    IS_RE2_AVAILABLE,
+    GitHubAppAuth,
+    get_repo,
+    get_branch,
+    get_blob_oids_graphql,
+    git_blob_sha,
+    commit_files_graphql,
+    github_cache_stats,
+    pr_cache,
+    pr_cache_stats,
     logger,
     IngestPayload,
     branch_prefix,
@@ -21,18 +33,37 @@ from utils import (
     extract_pr_body,
     update_pr_body,
     compare_line_by_line,
-    assert_throws,
+    expect,
     transform_file,
 )
 
 # BUILD_INFO is generated by the build pipeline (e.g. docker/metadata-action).
 # It looks like:
 # {"tags":["ghcr.io/watonomous/repo-ingestion:main"],"labels":{"org.opencontainers.image.title":"repo-ingestion","org.opencontainers.image.description":"Simple server to receive file changes and open GitHub pull requests","org.opencontainers.image.url":"https://github.com/WATonomous/repo-ingestion","org.opencontainers.image.source":"https://github.com/WATonomous/repo-ingestion","org.opencontainers.image.version":"main","org.opencontainers.image.created":"2024-01-20T16:10:39.421Z","org.opencontainers.image.revision":"1d55b62b15c78251e0560af9e97927591e260a98","org.opencontainers.image.licenses":""}}
-BUILD_INFO=json.loads(os.getenv("DOCKER_METADATA_OUTPUT_JSON", "{}"))
+BUILD_INFO=orjson.loads(os.getenv("DOCKER_METADATA_OUTPUT_JSON", "{}"))
 IS_SENTRY_ENABLED = os.getenv("SENTRY_DSN") is not None
 
-# Set up Sentry
-if IS_SENTRY_ENABLED:
+def sentry_traces_sampler(sampling_context):
+    # Inherit parent sampling decision
+    if sampling_context["parent_sampled"] is not None:
+        return sampling_context["parent_sampled"]
+
+    # Don't need to sample health checks or metrics scrapes
+    path = sampling_context.get("asgi_scope", {}).get("path", "")
+    if path.startswith("/health") or path.startswith("/metrics"):
+        return 0
+    
+    # Sample everything else
+    return 1
+
+def set_up_sentry():
+    """
+    Initialize Sentry.
+    """
+    if not IS_SENTRY_ENABLED:
+        print("No Sentry DSN found. Skipping Sentry setup.")
+        return
+
     build_labels = BUILD_INFO.get("labels", {})
     image_title = build_labels.get("org.opencontainers.image.title", "unknown_image")
     image_version = build_labels.get("org.opencontainers.image.version", "unknown_version")
@@ -52,18 +83,6 @@ if IS_SENTRY_ENABLED:
         event_level=logging.ERROR  # Send errors as events
     )
 
-    def sentry_traces_sampler(sampling_context):
-        # Inherit parent sampling decision
-        if sampling_context["parent_sampled"] is not None:
-            return sampling_context["parent_sampled"]
-
-        # Don't need to sample health checks
-        if sampling_context.get("asgi_scope", {}).get("path", "").startswith("/health"):
-            return 0
-        
-        # Sample everything else
-        return 1
-
     sentry_sdk.init(
         **sentry_config,
         integrations=[sentry_logging],
@@ -76,15 +95,39 @@ if IS_SENTRY_ENABLED:
 
         enable_tracing=True,
     )
-else:
-    print("No Sentry DSN found. Skipping Sentry setup.")
 
-app = FastAPI()
+# Sentry must be initialized before the app and its routes are created so that its FastAPI integration can patch them.
+set_up_sentry()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    set_up_logging()
+    logger.info(f"Logging configured with level {logger.level} ({logging.getLevelName(logger.level)})")
+    if not IS_RE2_AVAILABLE:
+        logger.warning("google-re2 is not installed. Content regexes that set `content_re2` will fail to compile.")
+
+    # A single pooled client is shared by all requests so that connections to the GitHub API are reused.
+    async with httpx.AsyncClient(
+        base_url="https://api.github.com",
+        http2=True,
+        headers={
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28",
+        },
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        # httpx defaults to 5 seconds, which large GraphQL commits and blob lookups can exceed
+        timeout=httpx.Timeout(60, connect=10),
+    ) as client:
+        client.auth = GitHubAppAuth(client)
+        app.state.gh = client
+        yield
+
+app = FastAPI(lifespan=lifespan)
 state = {
     "sentry_cron_last_ping_time": 0,
-    "num_ingest_requests_received": 0,
-    "num_ingest_requests_success": 0,
 }
+INGEST_REQUESTS_RECEIVED = Counter("ingest_requests_received", "Number of /ingest requests received")
+INGEST_REQUESTS_SUCCESS = Counter("ingest_requests_success", "Number of /ingest requests that completed successfully")
 
 # Add CORS for local development. In production, this is handled by the reverse proxy.
 origins = [
@@ -99,33 +142,36 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.on_event("startup")
-async def startup_event():
-    set_up_logging()
-    logger.info(f"Logging configured with level {logger.level} ({logging.getLevelName(logger.level)})")
+def ping_sentry(success):
+    capture_checkin(
+        monitor_slug='repo-ingestion',
+        status=MonitorStatus.OK if success else MonitorStatus.ERROR,
+        monitor_config={
+            "schedule": { "type": "interval", "value": 1, "unit": "minute" },
+            "checkin_margin": 5, # minutes
+            "max_runtime": 1, # minutes
+            "failure_issue_threshold": 1,
+            "recovery_threshold": 2,
+        }
+    )
+    logging.info(f"Pinged Sentry CRON with status {'OK' if success else 'ERROR'}")
 
 @app.get("/health")
-def read_health():
+async def read_health(background_tasks: BackgroundTasks):
     current_time = time.time()
     success = True
     # Assuming the /health endpoint is called every 10 seconds, ping Sentry about once every minute.
+    # The ping runs after the response is sent so that health checks never wait on Sentry.
     if IS_SENTRY_ENABLED and current_time - state["sentry_cron_last_ping_time"] > 50:
         state["sentry_cron_last_ping_time"] = current_time
-        capture_checkin(
-            monitor_slug='repo-ingestion',
-            status=MonitorStatus.OK if success else MonitorStatus.ERROR,
-            monitor_config={
-                "schedule": { "type": "interval", "value": 1, "unit": "minute" },
-                "checkin_margin": 5, # minutes
-                "max_runtime": 1, # minutes
-                "failure_issue_threshold": 1,
-                "recovery_threshold": 2,
-            }
-        )
-        logging.info(f"Pinged Sentry CRON with status {'OK' if success else 'ERROR'}")
+        background_tasks.add_task(ping_sentry, success)
 
     return {"status": "ok"}
 
+@app.get("/metrics")
+def read_metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/build-info")
 def read_build_info():
     return BUILD_INFO
@@ -137,16 +183,31 @@ def read_runtime_info():
         "sentry_sdk_version": sentry_sdk.VERSION,
         "deployment_environment": os.getenv("DEPLOYMENT_ENVIRONMENT", "unknown"),
         "sentry_cron_last_ping_time": state["sentry_cron_last_ping_time"],
-        "num_ingest_requests_received": state["num_ingest_requests_received"],
-        "num_ingest_requests_success": state["num_ingest_requests_success"],
+        "num_ingest_requests_received": int(INGEST_REQUESTS_RECEIVED._value.get()),
+        "num_ingest_requests_success": int(INGEST_REQUESTS_SUCCESS._value.get()),
+        "github_cache_hits": github_cache_stats["hits"],
+        "github_cache_misses": github_cache_stats["misses"],
+        "pr_cache_hits": pr_cache_stats["hits"],
+        "pr_cache_misses": pr_cache_stats["misses"],
     }
 
+pr_body_header = dedent("""
+    ### Introduction
+
+    This PR is automatically generated by the [repo-ingestion](https://github.com/WATonomous/repo-ingestion) service.
+
+    <!-- tags: repo-ingestion -->
+
+    ### Files in the latest submission:
+
+""")
+
 @app.post("/ingest")
-def ingest(payload: IngestPayload):
+async def ingest(payload: IngestPayload):
     """
     Ingests a payload and creates a PR.
     """
-    state["num_ingest_requests_received"] += 1
+    INGEST_REQUESTS_RECEIVED.inc()
 
     validate_ingest_payload(payload)
 
@@ -154,71 +215,87 @@ def ingest(payload: IngestPayload):
     for file in payload.files:
         transform_file(file)
 
-    g = Github(get_github_token())
-    logger.info(f"GitHub rate limit remaining: {g.rate_limiting[0]} / {g.rate_limiting[1]}")
-    repo = g.get_repo(payload.repo)
+    gh = app.state.gh
 
-    default_branch = repo.get_branch(repo.default_branch)
+    repo = await get_repo(gh, payload.repo)
+    default_branch = await get_branch(gh, payload.repo, repo["default_branch"])
     
     # Create branch
     branch_name = f"{branch_prefix}{payload.branch_suffix}"
-    logger.info(f"Creating branch {branch_name} from {default_branch.commit.sha}")
-    try:
-        branch = repo.create_git_ref(f"refs/heads/{branch_name}", default_branch.commit.sha)
-    except GithubException as e:
-        # 422 is "Reference already exists"
-        if e.status != 422:
-            raise e
+    logger.info(f"Creating branch {branch_name} from {default_branch['commit']['sha']}")
+    res = await gh.post(f"/repos/{payload.repo}/git/refs", json={
+        "ref": f"refs/heads/{branch_name}",
+        "sha": default_branch["commit"]["sha"],
+    })
+    # 422 is "Reference already exists"
+    if res.status_code == 422:
         logger.info(f"Branch {branch_name} already exists")
-
-    # Create/update files
-    for file in payload.files:
-        logger.info(f"Creating/updating file {file.path}...")
-        try:
-            existing_file = repo.get_contents(file.path, ref=branch_name)
-        except GithubException as e:
-            if e.status != 404:
-                raise e
-            existing_file = None
-
-        if existing_file:
-            repo.update_file(existing_file.path, f"Create or update {file.path}", file.content, existing_file.sha, branch=branch_name)
-        else:
-            logger.info(f"File {file.path} does not exist. Creating...")
-            repo.create_file(file.path, f"Create or update {file.path}", file.content, branch=branch_name)
+        res = await gh.get(f"/repos/{payload.repo}/git/ref/heads/{quote(branch_name)}")
+        res.raise_for_status()
+    else:
+        res.raise_for_status()
+    branch_head_oid = res.json()["object"]["sha"]
+
+    # Create/update files in a single commit, skipping files that are already up to date
+    existing_oids = await get_blob_oids_graphql(gh, payload.repo, branch_head_oid, [file.path for file in payload.files])
+    changed_files = [file for file in payload.files if existing_oids[file.path] != git_blob_sha(file.content)]
+    if changed_files:
+        logger.info(f"Committing {len(changed_files)} changed file(s) to {branch_name} on top of {branch_head_oid}...")
+        commit = await commit_files_graphql(gh, payload.repo, branch_name, changed_files, branch_head_oid)
+        logger.info(f"Created commit {commit['oid']}")
+    else:
+        logger.info(f"All files are up to date on {branch_name}. Skipping commit.")
 
     # Create PR
-    pr_head = f"{repo.organization.login}:{branch_name}"
-    logger.info(f"Creating PR from {pr_head} to {default_branch.name}...")
-    file_list = "".join([f"* {file.path}\n" for file in payload.files])
+    pr_head = f"{repo['owner']['login']}:{branch_name}"
+    logger.info(f"Creating PR from {pr_head} to {default_branch['name']}...")
     pr_title = f"Create or update files: {pr_head}"
-    pr_body = dedent(f"""
-        ### Introduction
-
-        This PR is automatically generated by the [repo-ingestion](https://github.com/WATonomous/repo-ingestion) service.
-
-        <!-- tags: repo-ingestion -->
-
-        ### Files in the latest submission:
-
-    """) + file_list
-    try:
-        prs = repo.get_pulls(head=pr_head, base=default_branch.name)
-        pr = prs[0]
-        assert_throws(lambda: prs[1], IndexError, f"Expected only one PR from {pr_head} to {default_branch.name}, but found more than one")
-        if pr.title == pr_title and compare_line_by_line(extract_pr_body(pr.body).strip(), pr_body.strip()):
-            logger.info(f"PR from {pr_head} to {default_branch.name} already exists (#{pr.number}) and is up to date")
-        else:
-            logger.info(f"PR from {pr_head} to {default_branch.name} already exists (#{pr.number}) but is out of date. Updating...")
-            pr.edit(title=pr_title, body=update_pr_body(pr.body, pr_body))
-    except IndexError:
-        logger.info(f"PR from {pr_head} to {default_branch.name} does not exist. Creating...")
-        pr = repo.create_pull(title=pr_title, body=update_pr_body("", pr_body), head=pr_head, base=default_branch.name)
-
-    logger.info(f"GitHub rate limit remaining: {g.rate_limiting[0]} / {g.rate_limiting[1]}")
-
-    state["num_ingest_requests_success"] += 1
+    pr_body = pr_body_header + "".join(f"* {file.path}\n" for file in payload.files)
+    pr_key = (payload.repo, pr_head, default_branch["name"])
+    pr_hash = hash((pr_title, pr_body))
+    cached_pr = pr_cache.get(pr_key)
+    if cached_pr and cached_pr["hash"] == pr_hash:
+        pr_cache_stats["hits"] += 1
+        logger.info(f"PR from {pr_head} to {default_branch['name']} (#{cached_pr['number']}) was recently synced and is up to date")
+        pr = cached_pr
+    else:
+        pr_cache_stats["misses"] += 1
+        res = await gh.get(f"/repos/{payload.repo}/pulls", params={"head": pr_head, "base": default_branch["name"]})
+        res.raise_for_status()
+        prs = res.json()
+        try:
+            pr = prs[0]
+            with expect(IndexError, f"Expected only one PR from {pr_head} to {default_branch['name']}, but found more than one"):
+                prs[1]
+            if pr["title"] == pr_title and compare_line_by_line(extract_pr_body(pr["body"]).strip(), pr_body.strip()):
+                logger.info(f"PR from {pr_head} to {default_branch['name']} already exists (#{pr['number']}) and is up to date")
+            else:
+                logger.info(f"PR from {pr_head} to {default_branch['name']} already exists (#{pr['number']}) but is out of date. Updating...")
+                res = await gh.patch(f"/repos/{payload.repo}/pulls/{pr['number']}", json={
+                    "title": pr_title,
+                    "body": update_pr_body(pr["body"], pr_body),
+                })
+                res.raise_for_status()
+        except IndexError:
+            logger.info(f"PR from {pr_head} to {default_branch['name']} does not exist. Creating...")
+            res = await gh.post(f"/repos/{payload.repo}/pulls", json={
+                "title": pr_title,
+                "body": update_pr_body("", pr_body),
+                "head": pr_head,
+                "base": default_branch["name"],
+            })
+            res.raise_for_status()
+            pr = res.json()
+        pr_cache[pr_key] = {
+            "number": pr["number"],
+            "html_url": pr["html_url"],
+            "hash": pr_hash,
+        }
+
+    logger.info(f"GitHub rate limit remaining: {res.headers.get('x-ratelimit-remaining')} / {res.headers.get('x-ratelimit-limit')}")
+
+    INGEST_REQUESTS_SUCCESS.inc()
 
     return {
-        "pr_url": pr.html_url,
+        "pr_url": pr["html_url"],
     }
@@ -1,16 +1,34 @@
+import asyncio
+import base64
+import calendar
+import functools
+import hashlib
+import httpx
 import json
 import jwt
 import logging
+import orjson
 import os
 import re
-import requests
 import time
 import yaml
-from datetime import datetime, timedelta
+from cachetools import TTLCache
+from contextlib import contextmanager
 from enum import Enum
 from fastapi import HTTPException
 from pydantic import BaseModel
 
+try:
+    import re2
+except ImportError:
+    re2 = None
+IS_RE2_AVAILABLE = re2 is not None
+
+try:
+    from yaml import CSafeLoader as YAMLLoader, CSafeDumper as YAMLDumper
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader, SafeDumper as YAMLDumper
+
 logger = logging.getLogger()
 
 branch_prefix = "repo-ingestion-"
@@ -23,20 +41,37 @@ def set_up_logging():
     handler.setFormatter(formatter)
     logger.addHandler(handler)
 
+@functools.cache
+def load_signing_key(pem_path):
+    """
+    Load the GitHub App private key. The key is read from disk only once.
+    """
+    with open(pem_path, 'rb') as pem_file:
+        return jwt.jwk_from_pem(pem_file.read())
+
+jwt_cache = {
+    "token": None,
+    "exp": 0,
+}
+
 def get_jwt(app_id, pem_path):
     """
     Get a JWT for GitHub Apps authentication
     Derived from:
     https://docs.github.com/en/apps/creating-github-apps/authenticating-with-a-github-app/authenticating-as-a-github-app-installation#generating-an-installation-access-token
+    The JWT is cached and reused until shortly before it expires.
     """
-    with open(pem_path, 'rb') as pem_file:
-        signing_key = jwt.jwk_from_pem(pem_file.read())
+    if jwt_cache["token"] and time.time() < jwt_cache["exp"] - 60:
+        return jwt_cache["token"]
+
+    signing_key = load_signing_key(pem_path)
     
+    now = int(time.time())
     payload = {
         # Issued at time
-        'iat': int(time.time()),
+        'iat': now,
         # JWT expiration time (10 minutes maximum)
-        'exp': int(time.time()) + 600,
+        'exp': now + 600,
         # GitHub App's identifier
         'iss': app_id
     }
@@ -45,38 +80,215 @@ def get_jwt(app_id, pem_path):
     jwt_instance = jwt.JWT()
     encoded_jwt = jwt_instance.encode(payload, signing_key, alg='RS256')
 
+    jwt_cache["token"] = encoded_jwt
+    jwt_cache["exp"] = payload["exp"]
+
     return encoded_jwt
 
 github_token_cache = None
+# Serializes token refreshes so that concurrent requests don't each request a new token
+github_token_lock = asyncio.Lock()
+
+def get_cached_github_token():
+    """
+    Get the cached installation access token, or None if it is missing or about to expire.
+    """
+    if github_token_cache and time.time() < github_token_cache["_expires_epoch"] - 60:
+        logger.debug(f"Using cached token. Expires at {github_token_cache['expires_at']}")
+        return github_token_cache["token"]
+    return None
 
-def get_github_token():
+async def get_github_token(client):
+    """
+    Get an installation access token for the GitHub App.
+    `client` is the shared GitHub API client, so token refreshes reuse its pooled connections.
+    """
     global github_token_cache
 
-    if github_token_cache and datetime.strptime(github_token_cache["expires_at"], "%Y-%m-%dT%H:%M:%SZ") - datetime.utcnow() > timedelta(minutes=1):
-        logger.debug(f"Using cached token. Expires at {github_token_cache['expires_at']}")
+    token = get_cached_github_token()
+    if token:
+        return token
+
+    async with github_token_lock:
+        # Another request may have refreshed the token while we waited for the lock
+        token = get_cached_github_token()
+        if token:
+            return token
+
+        app_id = os.environ["GITHUB_APP_ID"]
+        installation_id = os.environ["GITHUB_APP_INSTALLATION_ID"]
+        pem_path = os.environ["GITHUB_APP_PRIVATE_KEY_PATH"]
+
+        jwt = get_jwt(app_id, pem_path)
+
+        # Get an access token for the installation
+        url = f"/app/installations/{installation_id}/access_tokens"
+        headers = {
+            'Authorization': f'Bearer {jwt}',
+        }
+
+        # auth=None bypasses GitHubAppAuth, since this request authenticates with the JWT instead
+        response = await client.post(url, headers=headers, auth=None)
+        response.raise_for_status()
+
+        github_token_cache = response.json()
+        # Parse the expiry once so that cache hits only need a number comparison
+        github_token_cache["_expires_epoch"] = calendar.timegm(time.strptime(github_token_cache["expires_at"], "%Y-%m-%dT%H:%M:%SZ"))
+
+        logger.debug(f"Generated new token. Expires at {github_token_cache['expires_at']}")
         return github_token_cache["token"]
 
-    app_id = os.environ["GITHUB_APP_ID"]
-    installation_id = os.environ["GITHUB_APP_INSTALLATION_ID"]
-    pem_path = os.environ["GITHUB_APP_PRIVATE_KEY_PATH"]
+class GitHubAppAuth(httpx.Auth):
+    """
+    Authenticate httpx requests as the GitHub App installation.
+    `client` is the client used to refresh the installation token.
+    """
+    def __init__(self, client):
+        self.client = client
 
-    jwt = get_jwt(app_id, pem_path)
+    async def async_auth_flow(self, request):
+        request.headers["Authorization"] = f"Bearer {await get_github_token(self.client)}"
+        yield request
 
-    # Get an access token for the installation
-    url = f"https://api.github.com/app/installations/{installation_id}/access_tokens"
-    headers = {
-        'Accept': 'application/vnd.github+json',
-        'Authorization': f'Bearer {jwt}',
-        'X-GitHub-Api-Version': '2022-11-28',
-    }
+github_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+}
+
+_MISSING = object()
+
+def cached(kind, ttl=60, maxsize=256):
+    """
+    Cache the results of an async GitHub lookup in memory for `ttl` seconds.
+    The wrapped function is called as `func(client, repo, *args)` and cached under `(repo, kind, *args)`.
+    Failed lookups (e.g. 404s) raise and are never cached.
+    """
+    def decorator(func):
+        cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        @functools.wraps(func)
+        async def wrapper(client, repo, *args):
+            key = (repo, kind, *args)
+            # The event loop is single-threaded, so the cache needs no lock between awaits.
+            # A single lookup, so the entry cannot expire between checking for it and reading it
+            result = cache.get(key, _MISSING)
+            if result is not _MISSING:
+                github_cache_stats["hits"] += 1
+                return result
+            github_cache_stats["misses"] += 1
+            result = await func(client, repo, *args)
+            cache[key] = result
+            return result
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
 
-    response = requests.post(url, headers=headers)
-    response.raise_for_status()
+@cached("repo")
+async def get_repo(client, repo):
+    """
+    Get the metadata of a repository.
+    """
+    res = await client.get(f"/repos/{repo}")
+    res.raise_for_status()
+    return res.json()
+
+@cached("branch")
+async def get_branch(client, repo, name):
+    """
+    Get a branch of a repository, including its head commit.
+    """
+    res = await client.get(f"/repos/{repo}/branches/{name}")
+    res.raise_for_status()
+    return res.json()
+
+async def graphql(client, query, variables):
+    """
+    Run a GraphQL query against the GitHub API and return its data.
+    """
+    res = await client.post("/graphql", json={"query": query, "variables": variables})
+    res.raise_for_status()
+    result = res.json()
+    # GraphQL reports errors in the response body with a 200 status
+    if result.get("errors"):
+        raise HTTPException(status_code=500, detail=f"GitHub GraphQL request failed: {result['errors']}")
+    return result["data"]
+
+def git_blob_sha(content: str) -> str:
+    """
+    Compute the Git blob SHA of `content`. This is the `sha`/`oid` GitHub reports for a file.
+    """
+    data = content.encode()
+    return hashlib.sha1(b"blob " + str(len(data)).encode() + b"\0" + data).hexdigest()
+
+async def get_blob_oids_graphql(client, repo, rev, paths):
+    """
+    Get the blob SHAs of `paths` at `rev` in a single GraphQL query.
+    Returns a dict from path to SHA. Paths that do not exist (or are not files) map to None.
+    """
+    if not paths:
+        return {}
+
+    owner, name = repo.split("/", 1)
+    aliases = [f"f{i}" for i in range(len(paths))]
+    query = (
+        "query ($owner: String!, $name: String!, "
+        + ", ".join(f"${alias}: String!" for alias in aliases)
+        + ") { repository(owner: $owner, name: $name) { "
+        + " ".join(f"{alias}: object(expression: ${alias}) {{ ... on Blob {{ oid }} }}" for alias in aliases)
+        + " } }"
+    )
+    variables = {"owner": owner, "name": name}
+    variables.update({alias: f"{rev}:{path}" for alias, path in zip(aliases, paths)})
+
+    data = await graphql(client, query, variables)
+    return {path: (data["repository"][alias] or {}).get("oid") for alias, path in zip(aliases, paths)}
+
+create_commit_on_branch_mutation = """
+mutation ($input: CreateCommitOnBranchInput!) {
+  createCommitOnBranch(input: $input) {
+    commit {
+      oid
+      url
+    }
+  }
+}
+"""
 
-    github_token_cache = response.json()
+async def commit_files_graphql(client, repo, branch, files, expected_head_oid):
+    """
+    Create or update all `files` on `branch` in a single commit using the GraphQL API.
+    `expected_head_oid` must be the current head of `branch`, otherwise GitHub rejects the commit.
+    Returns the created commit.
+    """
+    data = await graphql(client, create_commit_on_branch_mutation, {
+        "input": {
+            "branch": {
+                "repositoryNameWithOwner": repo,
+                "branchName": branch,
+            },
+            "message": {
+                "headline": "Create or update files",
+                "body": "".join(f"* {file.path}\n" for file in files),
+            },
+            "fileChanges": {
+                "additions": [
+                    {"path": file.path, "contents": base64.b64encode(file.content.encode()).decode()}
+                    for file in files
+                ],
+            },
+            "expectedHeadOid": expected_head_oid,
+        },
+    })
+    return data["createCommitOnBranch"]["commit"]
 
-    logger.debug(f"Generated new token. Expires at {github_token_cache['expires_at']}")
-    return github_token_cache["token"]
+# Recently synced PRs, keyed by `(repo, head, base)`. Re-ingesting an unchanged payload
+# can skip looking up the PR entirely while the entry is fresh.
+pr_cache = TTLCache(maxsize=256, ttl=60)
+pr_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+}
 
 class TransformType(str, Enum):
     json2yaml = "json2yaml"
@@ -95,11 +307,40 @@ class IngestPayload(BaseModel):
     branch_suffix: str
     files: list[File]
 
+def compile_content_regex(pattern, use_re2=False):
+    """
+    Compile a file content pattern.
+    With `use_re2`, the pattern is compiled with RE2, which matches in linear time and so cannot backtrack
+    catastrophically on large user-controlled content. RE2 is opt-in because some patterns match differently
+    under it (e.g. `$` only matches at the end of the text, and `\\d`, `\\s`, `\\w` are ASCII-only).
+    """
+    if not use_re2:
+        return re.compile(pattern)
+    if re2 is None:
+        raise RuntimeError(f"Content regex {pattern!r} requires RE2, but google-re2 is not installed")
+    return re2.compile(pattern)
+
+@functools.cache
+def get_allowed_ingest_payloads():
+    """
+    Parse ALLOWED_INGEST_PAYLOADS and compile its regexes. This is done once and reused for every request.
+    Returns a list of `(repo, branch_suffix, file_path, file_content)` compiled patterns.
+    """
+    return [
+        (
+            re.compile(allowed_payload["repo"]),
+            re.compile(allowed_payload["branch_suffix"]),
+            re.compile(allowed_payload["files"]["path"]),
+            compile_content_regex(allowed_payload["files"]["content"], allowed_payload["files"].get("content_re2", False)),
+        )
+        for allowed_payload in json.loads(os.environ["ALLOWED_INGEST_PAYLOADS"])
+    ]
+
 def validate_ingest_payload(payload: IngestPayload):
-    for allowed_payload in json.loads(os.environ["ALLOWED_INGEST_PAYLOADS"]):
-        if re.match(allowed_payload["repo"], payload.repo) and re.match(allowed_payload["branch_suffix"], payload.branch_suffix):
+    for repo_re, branch_suffix_re, path_re, content_re in get_allowed_ingest_payloads():
+        if repo_re.match(payload.repo) and branch_suffix_re.match(payload.branch_suffix):
             for file in payload.files:
-                if not re.match(allowed_payload["files"]["path"], file.path) or not re.match(allowed_payload["files"]["content"], file.content):
+                if not path_re.match(file.path) or not content_re.match(file.content):
                     raise HTTPException(status_code=400, detail=f"File {file.path} does not match allowed regex")
             return True
     raise HTTPException(status_code=400, detail=f"Payload does not match allowed regex")
@@ -108,6 +349,9 @@ def compare_line_by_line(str1, str2):
     """
     Compare two strings line by line. This is useful for comparing strings that may have different line endings.
     """
+    # Fast path for identical strings, which avoids splitting them into lists of lines
+    if str1 == str2:
+        return True
     return str1.splitlines() == str2.splitlines()
 
 pr_body_prefix = "<!-- This section is manged by repo-ingestion-bot. Please Do not edit manually! -->"
@@ -119,14 +363,31 @@ def wrap_pr_body(body):
     """
     return "\n\n" + pr_body_prefix + "\n" + body + "\n" + pr_body_postfix + "\n\n"
 
+def find_pr_body(body):
+    """
+    Find the managed section of the PR body in a single pass.
+    Returns the indices of the prefix and the postfix, or `(-1, -1)` if the section is missing.
+    """
+    start = body.find(pr_body_prefix)
+    if start == -1:
+        return -1, -1
+    end = body.find(pr_body_postfix, start + len(pr_body_prefix))
+    if end == -1:
+        return -1, -1
+    return start, end
+
 def extract_pr_body(body):
     """
     Extract the PR body from the prefix and postfix.
     """
-    if not body or pr_body_prefix not in body or pr_body_postfix not in body:
+    if not body:
         return ""
 
-    return body.split(pr_body_prefix)[1].split(pr_body_postfix)[0]
+    start, end = find_pr_body(body)
+    if start == -1:
+        return ""
+
+    return body[start + len(pr_body_prefix):end]
 
 def update_pr_body(body, new_body):
     """
@@ -135,22 +396,33 @@ def update_pr_body(body, new_body):
     if not body:
         return wrap_pr_body(new_body)
 
-    if pr_body_prefix not in body or pr_body_postfix not in body:
+    start, end = find_pr_body(body)
+    if start == -1:
         return body + wrap_pr_body(new_body)
     
-    return body.split(pr_body_prefix)[0].rstrip() + wrap_pr_body(new_body) + body.split(pr_body_postfix)[1].lstrip()
+    return body[:start].rstrip() + wrap_pr_body(new_body) + body[end + len(pr_body_postfix):].lstrip()
+
+# Effectively unlimited line width. libyaml stores the width in a C int, so `float('inf')` cannot be used.
+yaml_width = 2**31 - 1
 
 def json2yaml(json_str: str):
     """
     Convert JSON to YAML.
     """
-    return yaml.dump(json.loads(json_str), width=float('inf'))
+    try:
+        data = orjson.loads(json_str)
+    except orjson.JSONDecodeError:
+        # orjson rejects NaN/Infinity and integers wider than 64 bits, which json accepts
+        data = json.loads(json_str)
+    return yaml.dump(data, Dumper=YAMLDumper, width=yaml_width)
 
 def yaml2json(yaml_str: str):
     """
     Convert YAML to JSON.
     """
-    return json.dumps(yaml.safe_load(yaml_str))
+    # json.dumps rather than orjson: the output is committed to downstream repos, and orjson's output differs
+    # (no spaces after separators, unescaped non-ASCII, NaN/Infinity written as null).
+    return json.dumps(yaml.load(yaml_str, Loader=YAMLLoader))
 
 def transform_file(file: File) -> File:
     """
@@ -167,13 +439,14 @@ def transform_file(file: File) -> File:
     file.content = content
     return file
 
-def assert_throws(func, exception_class, message=None):
+@contextmanager
+def expect(exception_class, message=None):
     """
-    Assert that a function throws an exception.
+    Assert that the body of the `with` block throws an exception.
     """
     try:
-        func()
+        yield
     except exception_class:
         pass
     else:
-        raise AssertionError(message or f"{func} did not throw {exception_class}")
\ No newline at end of file
+        raise AssertionError(message or f"Expected {exception_class} to be thrown")